@@ -30,6 +30,10 @@ def gen_config(
     val_every=5,
     lr=2e-5,
     test_id=None,
+    image_cache=0, # images cached per dataloader worker, 0 -> off
+    image_blob=0, # read the new dataloader's images from packed per-town blobs, built on first use
+    amp=0, # mixed precision training and inference
+    compile=0, # torch.compile the model, needs torch>=2.2
     **kwargs, # for test_name=test
     ):
 
@@ -95,6 +99,10 @@ def gen_config(
         device=device,
         val_every=val_every,
         lr=lr,
+        image_cache=image_cache,
+        image_blob=image_blob,
+        amp=amp,
+        compile=compile,
 
         seq_len = 1, # input timesteps
         pred_len = 4, # future waypoints predicted
@@ -1,48 +1,53 @@
 import os
+import io
 import json
+import functools
+import tempfile
 from PIL import Image
 
 import numpy as np
 import torch 
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+from torchvision.io import decode_image, ImageReadMode
 import imageio
-from copy import deepcopy
 
 class CARLA_Data(Dataset):
-    def __init__(self, towns, config, len_from_data=False, imgaug=None, use_pseudo_data=False) -> None:
+    def __init__(self, towns, config, len_from_data=False, use_pseudo_data=False) -> None:
         print("New Dataloader")
         self.config = config
         self.seq_len = config['seq_len']
         self.pred_len = config['pred_len']
-        self.imgaug = imgaug
+        self.load_front = functools.lru_cache(maxsize=config['image_cache'])(load_front) if config['image_cache'] else load_front
         
-        self.data = dict(
-            turns=[],
-            in_motion=[],
-            long_stops=[],
-            short_stops=[],
-        )
+        modes = ['turns', 'in_motion', 'long_stops', 'short_stops']
+        self.modes = modes
+        self.mode_cdf = np.cumsum([0.25, 0.3, 0.25, 0.2])
+        self.mode_cdf[-1] = 1.0
+        data = {mode: [] for mode in modes}
 
         for town in towns:
-            town_data = np.load(f'{self.config["data_dir"]}/{town}/filtered_data.npy', allow_pickle=True).item()
-            self.data['turns'].extend(town_data['turns'])
-            self.data['in_motion'].extend(town_data['in_motion'])
-            self.data['long_stops'].extend(town_data['long_stops'])
-            self.data['short_stops'].extend(town_data['short_stops'])
+            town_data = load_fields(f'{self.config["data_dir"]}/{town}/filtered_data.npy', modes=modes, blob=config['image_blob'])
+            for mode in modes:
+                data[mode].append(town_data[mode])
     
         if use_pseudo_data:
             try:
                 print("Importing pseudo data")
-                ssd_data = np.load(f'{self.config["data_dir"]}/pseudo/{self.config["test_id"]}/filtered_data.npy', allow_pickle=True).item()
-                self.data['turns'].extend(ssd_data['turns'])
-                self.data['in_motion'].extend(ssd_data['in_motion'])
-                self.data['long_stops'].extend(ssd_data['long_stops'])
-                self.data['short_stops'].extend(ssd_data['short_stops'])
-            except:
+                ssd_data = load_fields(f'{self.config["data_dir"]}/pseudo/{self.config["test_id"]}/filtered_data.npy', modes=modes, blob=config['image_blob'])
+                for mode in modes:
+                    data[mode].append(ssd_data[mode])
+            except FileNotFoundError:
                 print('There is no pseudolabeled data')
 
+        self.data = {mode: concat_fields(data[mode]) for mode in modes}
+        self.mode_len = {mode: len(self.data[mode]['scene']) for mode in modes}
+        if not sum(self.mode_len.values()):
+            raise ValueError(f'No data found for towns {towns} (use_pseudo_data={use_pseudo_data})')
+        # encoded front images read from the packed blobs instead of one file per scene
+        self.images = {mode: PackedImages([part['image'] for part in data[mode]]) for mode in modes} if config['image_blob'] else None
 
-        self.length = (len(self.data['turns'])+len(self.data['in_motion'])+len(self.data['long_stops'])+len(self.data['short_stops'])) if len_from_data else 2000*64
+        self.length = sum(len(self.data[mode]['scene']) for mode in modes) if len_from_data else 2000*64
 
     def __len__(self):
         """Returns the length of the dataset. """
@@ -50,51 +55,48 @@ class CARLA_Data(Dataset):
 
     def __getitem__(self, index):
         try:
-            mode = np.random.choice(['turns','in_motion','long_stops', 'short_stops'], p=[0.25, 0.3, 0.25, 0.2])
-            index = np.random.randint(0, len(self.data[mode]))
-            item = self.data[mode][index]
-            img = np.array(scale_and_crop_image(Image.open(item['scene']), scale=self.config['scale'], crop=self.config['input_resolution']))
-            
-            example = deepcopy(item)
-            example['waypoints'] = [tuple(wp) for wp in item['waypoints']]
+            # mode sampling tables are built once in __init__
+            mode = self.modes[np.searchsorted(self.mode_cdf, np.random.random(), side='right')]
+            index = np.random.randint(0, self.mode_len[mode])
+            example = {field: values[index] for field, values in self.data[mode].items()}
+            example['scene'] = str(example['scene'])
             example['fronts'] = []
-            if self.imgaug is None:
-                example['fronts'].append(torch.from_numpy(img.transpose(2,0,1)))
+            # augmentation runs batched on the device, see Trainer.train
+            if self.images is not None:
+                example['fronts'].append(decode_front(self.images[mode][index], scale=self.config['scale'], crop=self.config['input_resolution']))
             else:
-                aug_img = self.imgaug.augment_image(img)
-                # imageio.imwrite(f'/mnt/qb/work/geiger/pghosh58/transfuser/vis/scenes/{index}.jpg', aug_img)  #write all changed images
-                example['fronts'].append(torch.from_numpy(aug_img.transpose(2,0,1)))
+                example['fronts'].append(self.load_front(example['scene'], scale=self.config['scale'], crop=self.config['input_resolution']))
             return example
             
         except:
             return self.__getitem__(index)
         
 class CARLA_Data2(Dataset):
-    def __init__(self, towns, config, len_from_data=False, imgaug=None, use_pseudo_data=False, what_if=False) -> None:
+    def __init__(self, towns, config, len_from_data=False, use_pseudo_data=False, what_if=False) -> None:
         print("Old Dataloader")
 
         self.config = config
         self.seq_len = config['seq_len']
         self.pred_len = config['pred_len']
-        self.imgaug = imgaug
+        self.load_front = functools.lru_cache(maxsize=config['image_cache'])(load_front) if config['image_cache'] else load_front
         self.what_if = what_if
         self.len_from_data = len_from_data
         
-        self.data = []
+        data = []
 
         for town in towns:
-            town_data = list(np.load(f'{self.config["data_dir"]}/{town}/processed_data.npy', allow_pickle=True))
-            self.data.extend(town_data)
+            data.append(load_fields(f'{self.config["data_dir"]}/{town}/processed_data.npy'))
         
         if use_pseudo_data:
             try:
                 print("Importing pseudo data")
-                ssd_data = list(np.load(f'{self.config["data_dir"]}/pseudo/{self.config["test_id"]}/processed_data.npy', allow_pickle=True))
-                self.data.extend(ssd_data)
-            except:
+                data.append(load_fields(f'{self.config["data_dir"]}/pseudo/{self.config["test_id"]}/processed_data.npy'))
+            except FileNotFoundError:
                 print('There is no pseudolabeled data')
 
-        self.length = len(self.data) if len_from_data else 2000*64
+        self.data = concat_fields(data)
+
+        self.length = len(self.data['scene']) if len_from_data else 2000*64
     
     def __len__(self):
         """Returns the length of the dataset. """
@@ -102,28 +104,19 @@ class CARLA_Data2(Dataset):
 
     def __getitem__(self, index):
         if not self.len_from_data:
-            index = np.random.randint(0, len(self.data))
-        item = self.data[index]
-        img = np.array(scale_and_crop_image(Image.open(item['scene']), scale=self.config['scale'], crop=self.config['input_resolution']))
-        
-        example = deepcopy(item)
-        example['waypoints'] = [tuple(wp) for wp in item['waypoints']]
+            index = np.random.randint(0, len(self.data['scene']))
+        example = {field: values[index] for field, values in self.data.items()}
+        example['scene'] = str(example['scene'])
         example['fronts'] = []
-        if self.imgaug is None:
-            example['fronts'].append(torch.from_numpy(img.transpose(2,0,1)))
-        else:
-            aug_img = self.imgaug.augment_image(img)
-            # imageio.imwrite(f'/mnt/qb/work/geiger/pghosh58/transfuser/vis/scenes/{index}.jpg', aug_img)  #write all changed images
-            example['fronts'].append(torch.from_numpy(aug_img.transpose(2,0,1)))
+        example['fronts'].append(self.load_front(example['scene'], scale=self.config['scale'], crop=self.config['input_resolution']))
         
         if self.what_if:
-            example['nav_command'] = np.zeros(6)
+            example['nav_command'] = np.zeros(6, dtype=np.float32)
             example['nav_command'][np.random.randint(0,4)] = 1
 
             theta = np.random.random() * np.pi
-            example['target_point'] = (50*np.random.random()) * np.array([np.cos(theta), np.sin(theta)])
+            example['target_point'] = (50*np.random.random()) * np.array([np.cos(theta), np.sin(theta)], dtype=np.float32)
             example['target_point'][1] = -example['target_point'][1]
-            example['target_point'] = tuple(example['target_point'])
 
         return example
 
@@ -349,16 +342,192 @@ class CARLA_Data2(Dataset):
 #         return data
 
 
+# fields of a processed item, each cached in its own .npy file (see load_fields)
+FIELDS = dict(
+    scene=str,
+    v1=np.float32,
+    v2=np.float32,
+    target_point=np.float32,
+    waypoints=np.float32,
+    nav_command=np.float32,
+)
+
+
+def load_fields(path, modes=None, blob=False):
+    """
+    Load the items pickled at path as one array per field. The arrays are cached in .npy
+    files next to path, so the pickle is only read when the cache is missing or older than it;
+    afterwards the fields are opened memory-mapped, which only makes loading fast, as concat_fields
+    copies them into memory. If modes is given, path holds a dict of item lists
+    and a dict of fields is returned per mode. If blob is set, the unique scene images of all modes
+    are packed once next to path (see pack_images) and every mode gets an extra 'image' entry of
+    (blob, offsets, index), index giving the blob position of each of its items.
+    """
+    keys = modes if modes is not None else [None]
+    stem = path[:-len('.npy')]
+    files = {key: {field: f'{stem}_{key}_{field}.npy' if key else f'{stem}_{field}.npy' for field in FIELDS} for key in keys}
+
+    if not all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(path) for key in keys for f in files[key].values()):
+        data = np.load(path, allow_pickle=True)
+        data = data.item() if modes is not None else {None: list(data)}
+        for key in keys:
+            for field, dtype in FIELDS.items():
+                save_atomic(files[key][field], np.array([item[field] for item in data[key]], dtype=dtype))
+
+    fields = {key: {field: np.load(f, mmap_mode='r') for field, f in files[key].items()} for key in keys}
+
+    if blob:
+        blob_file, offsets_file = f'{stem}_blob.bin', f'{stem}_offsets.npy'
+        index_files = {key: f'{stem}_{key}_image.npy' if key else f'{stem}_image.npy' for key in keys}
+        if not all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(path) for f in (blob_file, offsets_file, *index_files.values())):
+            # filter_data puts a scene into several modes (most turns are also in_motion), pack it only once
+            scenes = np.unique(np.concatenate([fields[key]['scene'] for key in keys]))
+            pack_images([str(scene) for scene in scenes], blob_file, offsets_file)
+            for key in keys:
+                save_atomic(index_files[key], np.searchsorted(scenes, fields[key]['scene']))
+        offsets = np.load(offsets_file)
+        # an empty file cannot be memory-mapped
+        images = np.memmap(blob_file, dtype=np.uint8, mode='r') if offsets[-1] else np.zeros(0, dtype=np.uint8)
+        for key in keys:
+            fields[key]['image'] = (images, offsets, np.load(index_files[key]))
+
+    return fields if modes is not None else fields[None]
+
+
+def open_atomic(path):
+    """
+    Open a uniquely named temporary file next to path for writing. Returns the file object and
+    its name, to be moved over path with os.replace once complete, so concurrent jobs building
+    the same cache never write into the same file and readers never see a partial one.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    # mkstemp creates the file owner-only, the cache lives in a shared data dir
+    os.chmod(tmp, 0o644)
+    return os.fdopen(fd, 'wb'), tmp
+
+
+def save_atomic(path, values):
+    """
+    np.save values to path through a unique temporary file, see open_atomic.
+    """
+    f, tmp = open_atomic(path)
+    try:
+        with f:
+            np.save(f, values)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def pack_images(paths, blob_file, offsets_file):
+    """
+    Write the encoded bytes of the images at paths back to back into blob_file and their (N+1,)
+    byte offsets into offsets_file, so reading image i is a slice of one memory-mapped file
+    instead of an open() per sample. An image that cannot be read is left empty, so decoding
+    it fails and __getitem__ draws another sample, as it would for the file itself.
+    """
+    offsets = np.zeros(len(paths)+1, dtype=np.int64)
+    out, tmp = open_atomic(blob_file)
+    try:
+        with out:
+            for i, path in enumerate(paths):
+                try:
+                    with open(path, 'rb') as f:
+                        out.write(f.read())
+                except OSError as e:
+                    print(f'Could not pack {path}: {e}')
+                offsets[i+1] = out.tell()
+        save_atomic(offsets_file, offsets)
+        os.replace(tmp, blob_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class PackedImages(object):
+    """
+    The (blob, offsets, index) 'image' entries of several load_fields calls indexed as one sequence
+    in concat_fields order. Indexing returns the encoded bytes of an image as a uint8 array.
+    """
+
+    def __init__(self, parts):
+        self.blobs = [blob for blob, _, _ in parts]
+        self.part = np.concatenate([np.full(len(index), i, dtype=np.int64) for i, (_, _, index) in enumerate(parts)] + [np.zeros(0, dtype=np.int64)])
+        self.start = np.concatenate([offsets[index] for _, offsets, index in parts] + [np.zeros(0, dtype=np.int64)])
+        self.end = np.concatenate([offsets[index+1] for _, offsets, index in parts] + [np.zeros(0, dtype=np.int64)])
+
+    def __len__(self):
+        return len(self.part)
+
+    def __getitem__(self, index):
+        # copied out of the memmap so torch gets a writable buffer
+        return np.array(self.blobs[self.part[index]][self.start[index]:self.end[index]])
+
+
+def concat_fields(fields_list):
+    """
+    Concatenate the per-field arrays of several load_fields calls into one contiguous in-memory array
+    per field, cast to the dtype in FIELDS so __getitem__ hands out float32 rows without any conversion.
+    The copy is kept on purpose, even for a single part: rows of the read-only memmaps would make
+    torch warn about non-writable arrays in every collate.
+    """
+    data = dict()
+    for field, dtype in FIELDS.items():
+        values = [fields[field] for fields in fields_list if len(fields[field])]
+        data[field] = np.concatenate(values).astype(dtype, copy=False) if values else np.array([], dtype=dtype)
+
+    # speeds as (1,) rows so the default collate already yields (B, 1) batches
+    data['v1'] = data['v1'].reshape((-1,1))
+    data['v2'] = data['v2'].reshape((-1,1))
+    return data
+
+
+def fast_collate(batch):
+    """
+    Collate a batch keeping the front images as raw uint8, one (B, 3, H, W) tensor per timestep.
+    The float conversion is left to the GPU so only a quarter of the bytes cross PCIe.
+    """
+    fronts = [default_collate([torch.as_tensor(front) for front in seq_fronts]) for seq_fronts in zip(*[example['fronts'] for example in batch])]
+    data = default_collate([{key: value for key, value in example.items() if key != 'fronts'} for example in batch])
+    data['fronts'] = fronts
+    return data
+
+
+def load_front(path, scale=1, crop=256):
+    """
+    Decode and center crop the image file at path, see decode_front.
+    """
+    return decode_front(np.fromfile(path, dtype=np.uint8), scale=scale, crop=crop)
+
+
+def decode_front(data, scale=1, crop=256):
+    """
+    Decode and center crop encoded image bytes (a uint8 array) straight into a channels-first uint8
+    tensor with torchvision.io, skipping the PIL to numpy copy and the HWC to CHW transpose.
+    Scaled images go through PIL. The crop is returned as its own contiguous tensor so it can be
+    kept in an image cache.
+    """
+    if scale != 1:
+        return torch.from_numpy(np.ascontiguousarray(scale_and_crop_image(Image.open(io.BytesIO(data.tobytes())), scale=scale, crop=crop).transpose(2,0,1)))
+    image = decode_image(torch.from_numpy(data), mode=ImageReadMode.RGB)
+    start_x = image.shape[1]//2 - crop//2
+    start_y = image.shape[2]//2 - crop//2
+    return image[:, start_x:start_x+crop, start_y:start_y+crop].contiguous()
+
+
 def scale_and_crop_image(image, scale=1, crop=256):
     """
-    Scale and crop a PIL image, returning a channels-first numpy array.
+    Scale and crop a PIL image, returning a contiguous channels-last uint8 numpy array.
+    The crop is taken in PIL coordinates so only the crop window is ever copied into numpy.
+    Install pillow-simd as a drop-in replacement for Pillow to get SIMD decode/resize kernels.
     """
-    (width, height) = (int(image.width // scale), int(image.height // scale))
-    im_resized = image.resize((width, height))
-    image = np.asarray(im_resized)
-    start_x = height//2 - crop//2
-    start_y = width//2 - crop//2
-    cropped_image = image[start_x:start_x+crop, start_y:start_y+crop]
+    if scale != 1:
+        (width, height) = (int(image.width // scale), int(image.height // scale))
+        image = image.resize((width, height))
+    start_x = image.height//2 - crop//2
+    start_y = image.width//2 - crop//2
+    cropped_image = np.array(image.crop((start_y, start_x, start_y+crop, start_x+crop)))
     
     # cropped_image = np.transpose(cropped_image, (2,0,1))
     return cropped_image
@@ -366,25 +535,19 @@ def scale_and_crop_image(image, scale=1, crop=256):
 
 def transform_2d_points(xyz, r1, t1_x, t1_y, r2, t2_x, t2_y):
     """
-    Build a rotation matrix and take the dot product.
+    Apply the rigid transform (r1, t1) to the points and then the inverse of (r2, t2).
+    The inverse is taken in closed form: transposed rotation of the offset to t2.
     """
-    # z value to 1 for rotation
-    xy1 = xyz.copy()
-    xy1[:,2] = 1
-
     c, s = np.cos(r1), np.sin(r1)
-    r1_to_world = np.matrix([[c, s, t1_x], [-s, c, t1_y], [0, 0, 1]])
-
-    # np.dot converts to a matrix, so we explicitly change it back to an array
-    world = np.asarray(r1_to_world @ xy1.T)
+    world_x = c*xyz[:,0] + s*xyz[:,1] + t1_x
+    world_y = -s*xyz[:,0] + c*xyz[:,1] + t1_y
 
     c, s = np.cos(r2), np.sin(r2)
-    r2_to_world = np.matrix([[c, s, t2_x], [-s, c, t2_y], [0, 0, 1]])
-    world_to_r2 = np.linalg.inv(r2_to_world)
-
-    out = np.asarray(world_to_r2 @ world).T
+    out = np.empty_like(xyz, dtype=np.float64)
+    out[:,0] = c*(world_x - t2_x) - s*(world_y - t2_y)
+    out[:,1] = s*(world_x - t2_x) + c*(world_y - t2_y)
     
     # reset z-coordinate
     out[:,2] = xyz[:,2]
 
-    return out
\ No newline at end of file
+    return out
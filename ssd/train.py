@@ -1,7 +1,8 @@
 import sys
+import ast
 from pprint import pprint
-config = dict()
-exec(f'config = {sys.argv[1]}')
+# the config is the repr of a dict of literals (see run2.gen_config)
+config = ast.literal_eval(sys.argv[1])
 pprint(config)
 
 import os
@@ -13,15 +14,16 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.nn.functional as F
 torch.autograd.set_detect_anomaly(True)
 torch.backends.cudnn.benchmark = True
+# share batches through files instead of file descriptors, which long-lived persistent workers can exhaust
+torch.multiprocessing.set_sharing_strategy('file_system')
 
 from utils import filter_data
-from imgaug import augmenters as iaa, imgaug
 
 from model import AIM
 
-from trainer import Trainer
+from trainer import Trainer, SomeOf, GaussianNoise, Multiply, GaussianBlur, Dropout, SaltAndPepper
 
-from data import CARLA_Data2
+from data import CARLA_Data2, fast_collate
 if config['dataloader'] == 1:
     from data import CARLA_Data
 elif config['dataloader'] == 0:
@@ -31,17 +33,16 @@ elif config['dataloader'] == 0:
 
 
 if config['imgaug']:
-    imgaug = iaa.Sequential([
-                iaa.SomeOf((0,2),
+    # the former imgaug pipeline, batched on the device by the trainer
+    imgaug = SomeOf((0,2),
                 [
-                    iaa.AdditiveGaussianNoise(scale=0.08*255, per_channel=True),
-                    iaa.AdditiveGaussianNoise(scale=0.08*255),
-                    iaa.Multiply((0.5, 1.5)),
-                    iaa.GaussianBlur(sigma=(0.0, 0.8)),
-                    iaa.Dropout(p=(0, 0.1)),
-                    iaa.SaltAndPepper(0.05),
-                ], random_order=True),
-            ])
+                    GaussianNoise(0.08*255, per_channel=True),
+                    GaussianNoise(0.08*255),
+                    Multiply(0.5, 1.5),
+                    GaussianBlur(0.8),
+                    Dropout(0.1),
+                    SaltAndPepper(0.05),
+                ])
 else:
     imgaug = None
 
@@ -53,11 +54,18 @@ config['logdir'] = os.path.join(config['logdir'], 'saved_model')
 writer = SummaryWriter(log_dir=config['logdir'])
 
 # Data
+# workers sized from the cpus the job was allocated (slurm --cpus-per-task), not the node's core count,
+# and capped for nodes without an affinity limit
+loader_kwargs = dict(num_workers=min(len(os.sched_getaffinity(0)), 16), pin_memory=True, collate_fn=fast_collate)
+# the train and val loaders are iterated every epoch, so their workers survive between epochs instead
+# of being re-forked, along with their image caches; the one-shot label collection loaders are not
+epoch_loader_kwargs = dict(loader_kwargs, persistent_workers=True, prefetch_factor=4)
+
 # train_set = CARLA_Data(root=config.train_data, config=config)
-val_set = CARLA_Data(towns=config['validation_towns'], config=config, imgaug=None, len_from_data=True)
+val_set = CARLA_Data(towns=config['validation_towns'], config=config, len_from_data=True)
 
 # dataloader_train = DataLoader(train_set, batch_size=config['batch_size'], shuffle=True, num_workers=8, pin_memory=True)
-dataloader_val = DataLoader(val_set, batch_size=config['batch_size'], shuffle=False, num_workers=8, pin_memory=True)
+dataloader_val = DataLoader(val_set, batch_size=config['batch_size'], shuffle=False, **epoch_loader_kwargs)
 
 # Model
 model = AIM(config, config['device'])
@@ -79,20 +87,29 @@ if config['load_model']:
         except:
             raise 'failed to load the model'
 
+if config['compile']:
+    if not hasattr(torch.nn.Module, 'compile'):
+        raise RuntimeError(f"compile=1 needs torch>=2.2 for nn.Module.compile, found torch {torch.__version__}")
+    # nn.Module.compile (torch>=2.2) compiles in place, so the state_dict keys and saved checkpoints stay the same
+    # reduce-overhead replays CUDA graphs, the fixed (batch_size, 3, 256, 256) batches make it worthwhile
+    model.image_encoder.compile(mode='reduce-overhead')
+    model.compile(mode='reduce-overhead')
+
 trainer.val_dataloader = dataloader_val
 
 if config['training_type'][:2] == 'ss':
     if config['training_type'] == 'ssf':
         print("Training with Pseudolabels")
-        train_set = CARLA_Data(towns=[], config=config, imgaug=imgaug, use_pseudo_data=True)
+        train_set = CARLA_Data(towns=[], config=config, use_pseudo_data=True)
         n_epochs = config['epochs']//2
     elif config['training_type'] == 'ssgt':
         print("Training with Pseudolabels and GT")
-        train_set = CARLA_Data(towns=config['supervised_towns'], config=config, imgaug=imgaug, use_pseudo_data=True)
+        train_set = CARLA_Data(towns=config['supervised_towns'], config=config, use_pseudo_data=True)
         n_epochs = config['epochs']
 
-    dataloader_train = DataLoader(train_set, batch_size=config['batch_size'], shuffle=True, num_workers=8, pin_memory=True)
+    dataloader_train = DataLoader(train_set, batch_size=config['batch_size'], shuffle=True, **epoch_loader_kwargs)
     trainer.train_dataloader = dataloader_train
+    trainer.augment = imgaug
 
     for epoch in range(trainer.cur_epoch, n_epochs): 
         trainer.train()
@@ -106,8 +123,9 @@ if config['training_type'][:2] == 'ss':
 if config['training_type'] == 'ssf':
     print("Fine Tuning")
     train_set = CARLA_Data(towns=config['supervised_towns'], config=config)
-    dataloader_train = DataLoader(train_set, batch_size=config['batch_size'], shuffle=True, num_workers=8, pin_memory=True)
+    dataloader_train = DataLoader(train_set, batch_size=config['batch_size'], shuffle=True, **epoch_loader_kwargs)
     trainer.train_dataloader = dataloader_train
+    trainer.augment = None
    
     for epoch in range(trainer.cur_epoch, config['epochs']): 
         trainer.train()
@@ -117,9 +135,10 @@ if config['training_type'] == 'ssf':
 
 if config['training_type'] == 's':
     print("Supervised Training")
-    train_set = CARLA_Data(towns=config['supervised_towns'], config=config, imgaug=imgaug, len_from_data=False)
-    dataloader_train = DataLoader(train_set, batch_size=config['batch_size'], shuffle=True, num_workers=8, pin_memory=True)
+    train_set = CARLA_Data(towns=config['supervised_towns'], config=config, len_from_data=False)
+    dataloader_train = DataLoader(train_set, batch_size=config['batch_size'], shuffle=True, **epoch_loader_kwargs)
     trainer.train_dataloader = dataloader_train
+    trainer.augment = imgaug
     
     for epoch in range(trainer.cur_epoch, config['epochs']): 
         trainer.train()
@@ -128,14 +147,18 @@ if config['training_type'] == 's':
             trainer.save()
     trainer.save()
 
+    # shut down the persistent train and val workers before the label collection loaders start theirs
+    trainer.train_dataloader = trainer.val_dataloader = None
+    del dataloader_train, dataloader_val
+
     print("Collect Labels")
-    ssd_set = CARLA_Data2(towns=config['self_supervised_towns'], config=config, imgaug=None, len_from_data=True)
-    dataloader_ssd = DataLoader(ssd_set, batch_size=config['batch_size'], shuffle=False, num_workers=8, pin_memory=True)
+    ssd_set = CARLA_Data2(towns=config['self_supervised_towns'], config=config, len_from_data=True)
+    dataloader_ssd = DataLoader(ssd_set, batch_size=config['batch_size'], shuffle=False, **loader_kwargs)
     trainer.ss_dataloader = dataloader_ssd
     trainer.get_labels()
 
-    ssd_set = CARLA_Data2(towns=config['self_supervised_towns'], config=config, imgaug=None, len_from_data=True, what_if=True)
-    dataloader_ssd = DataLoader(ssd_set, batch_size=config['batch_size'], shuffle=False, num_workers=8, pin_memory=True)
+    ssd_set = CARLA_Data2(towns=config['self_supervised_towns'], config=config, len_from_data=True, what_if=True)
+    dataloader_ssd = DataLoader(ssd_set, batch_size=config['batch_size'], shuffle=False, **loader_kwargs)
     trainer.ss_dataloader = dataloader_ssd
     for _ in range(config['what_if']):
         trainer.get_labels()
@@ -6,16 +6,180 @@ from tqdm import tqdm
 import os
 import json
 
+class CUDAPrefetcher(object):
+	"""Iterates over a dataloader while copying the next batch to the device on a side stream,
+	so the host-to-device transfer overlaps with the compute on the current batch.
+	Front images are cast to float on the device.
+	Args
+		- loader (DataLoader): Dataloader to wrap, should use pin_memory=True.
+		- device (str): Device to move the batches to.
+	"""
+
+	def __init__(self, loader, device):
+		self.loader = loader
+		self.device = torch.device(device)
+		self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+	def __len__(self):
+		return len(self.loader)
+
+	def __iter__(self):
+		loader_iter = iter(self.loader)
+		batch = self.preload(loader_iter)
+		while batch is not None:
+			if self.stream is not None:
+				torch.cuda.current_stream(self.device).wait_stream(self.stream)
+				self.record_stream(batch)
+			next_batch = self.preload(loader_iter)
+			yield batch
+			batch = next_batch
+
+	def preload(self, loader_iter):
+		try:
+			batch = next(loader_iter)
+		except StopIteration:
+			return None
+
+		if self.stream is None:
+			return self.to_device(batch)
+		with torch.cuda.stream(self.stream):
+			return self.to_device(batch)
+
+	def to_device(self, batch):
+		batch = self.move(batch)
+		batch['fronts'] = [front.float() for front in batch['fronts']]
+		return batch
+
+	def move(self, x):
+		if torch.is_tensor(x):
+			return x.to(self.device, non_blocking=True)
+		if isinstance(x, dict):
+			return {key: self.move(value) for key, value in x.items()}
+		if isinstance(x, (list, tuple)):
+			return type(x)(self.move(value) for value in x)
+		return x
+
+	def record_stream(self, x):
+		# tensors allocated on the side stream are consumed on the current one
+		if torch.is_tensor(x):
+			x.record_stream(torch.cuda.current_stream(self.device))
+		elif isinstance(x, dict):
+			for value in x.values():
+				self.record_stream(value)
+		elif isinstance(x, (list, tuple)):
+			for value in x:
+				self.record_stream(value)
+
+
+class SomeOf(torch.nn.Module):
+	"""Applies between n[0] and n[1] of the augmenters to every image of a batch on the device,
+	chosen per image like imgaug.SomeOf(n, augmenters, random_order=True). The order is shuffled
+	per batch rather than per image. Images are 0-255 floats and are clipped to that range after
+	every augmenter, as imgaug does for uint8 images.
+	Args
+		- n (tuple): Minimum and maximum number of augmenters per image.
+		- augmenters (list): Modules mapping a (B, C, H, W) batch to an augmented batch.
+	"""
+
+	def __init__(self, n, augmenters):
+		super().__init__()
+		self.n = n
+		self.augmenters = torch.nn.ModuleList(augmenters)
+
+	def forward(self, x):
+		b, n = x.shape[0], len(self.augmenters)
+		count = torch.randint(self.n[0], self.n[1]+1, (b, 1), device=x.device)
+		# a random rank per augmenter, the ones ranked below count are applied
+		chosen = torch.rand(b, n, device=x.device).argsort(1).argsort(1) < count
+		# every augmenter runs on the whole batch and is masked, which avoids a host sync per augmenter
+		for i in torch.randperm(n).tolist():
+			x = torch.where(chosen[:, i, None, None, None], self.augmenters[i](x).clamp_(0, 255), x)
+		return x
+
+
+class GaussianNoise(torch.nn.Module):
+	"""Adds gaussian noise, drawn per channel or shared by the channels of a pixel (imgaug.AdditiveGaussianNoise)."""
+
+	def __init__(self, std, per_channel=False):
+		super().__init__()
+		self.std = std
+		self.per_channel = per_channel
+
+	def forward(self, x):
+		shape = x.shape if self.per_channel else (x.shape[0], 1) + tuple(x.shape[2:])
+		return x + self.std * torch.randn(shape, device=x.device, dtype=x.dtype)
+
+
+class Multiply(torch.nn.Module):
+	"""Multiplies every image by a factor drawn from U(low, high) (imgaug.Multiply)."""
+
+	def __init__(self, low, high):
+		super().__init__()
+		self.low = low
+		self.high = high
+
+	def forward(self, x):
+		return x * torch.empty(x.shape[0], 1, 1, 1, device=x.device, dtype=x.dtype).uniform_(self.low, self.high)
+
+
+class GaussianBlur(torch.nn.Module):
+	"""Blurs every image with its own sigma drawn from U(0, sigma) (imgaug.GaussianBlur), as a separable
+	grouped convolution with one kernel per image and channel."""
+
+	def __init__(self, sigma, kernel_size=5):
+		super().__init__()
+		self.sigma = sigma
+		self.kernel_size = kernel_size
+
+	def forward(self, x):
+		b, c, h, w = x.shape
+		r = self.kernel_size // 2
+		sigma = torch.empty(b, 1, device=x.device, dtype=x.dtype).uniform_(0, self.sigma).clamp_(min=1e-3)
+		t = torch.arange(-r, r+1, device=x.device, dtype=x.dtype)
+		kernel = torch.exp(-t**2 / (2 * sigma**2))
+		kernel = (kernel / kernel.sum(1, keepdim=True)).repeat_interleave(c, 0)
+		x = x.reshape(1, b*c, h, w)
+		x = F.conv2d(F.pad(x, (r, r, 0, 0), mode='reflect'), kernel[:, None, None, :], groups=b*c)
+		x = F.conv2d(F.pad(x, (0, 0, r, r), mode='reflect'), kernel[:, None, :, None], groups=b*c)
+		return x.reshape(b, c, h, w)
+
+
+class Dropout(torch.nn.Module):
+	"""Zeroes pixels with a per-image probability drawn from U(0, p), the same for all channels (imgaug.Dropout)."""
+
+	def __init__(self, p):
+		super().__init__()
+		self.p = p
+
+	def forward(self, x):
+		p = torch.empty(x.shape[0], 1, 1, 1, device=x.device, dtype=x.dtype).uniform_(0, self.p)
+		return x * (torch.rand_like(x[:, :1]) >= p).to(x.dtype)
+
+
+class SaltAndPepper(torch.nn.Module):
+	"""Replaces pixels with probability p by white or black, the same for all channels (imgaug.SaltAndPepper)."""
+
+	def __init__(self, p):
+		super().__init__()
+		self.p = p
+
+	def forward(self, x):
+		noisy = torch.rand_like(x[:, :1]) < self.p
+		salt = (torch.rand_like(x[:, :1]) < 0.5).to(x.dtype) * 255.
+		return torch.where(noisy, salt, x)
+
+
 class Trainer(object):
 	"""Engine that runs training and inference.
 	Args
 		- cur_epoch (int): Current epoch.
 		- print_every (int): How frequently (# batches) to print loss.
 		- validate_every (int): How frequently (# epochs) to run validation.
+		- log_interval (int): How frequently (# batches) to log the train loss.
 		
 	"""
 
-	def __init__(self, config, model, optimizer, writer, cur_epoch=0, cur_iter=0):
+	def __init__(self, config, model, optimizer, writer, cur_epoch=0, cur_iter=0, log_interval=50):
 		self.cur_epoch = cur_epoch
 		self.cur_iter = cur_iter
 		self.bestval_epoch = cur_epoch
@@ -29,37 +193,52 @@ class Trainer(object):
 		self.train_dataloader = None
 		self.val_dataloader = None
 		self.ss_dataloader = None
+		# augmentation applied to the train fronts on the device, None -> off
+		self.augment = None
 		self.writer = writer
+		self.log_interval = log_interval
+		# mixed precision: a disabled scaler passes the loss and optimizer step through unchanged
+		# the config holds amp as an int, autocast only accepts a bool
+		self.amp = bool(self.config['amp'])
+		self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp)
 		# self.len_model_parameters = len(list(self.model.parameters()))
 
 	def train(self):
-		loss_epoch = 0.
+		loss_epoch = torch.zeros((), device=self.config['device'])
 		num_batches = 0
 		self.model.train()
 
 		# Train loop
-		for data in tqdm(self.train_dataloader):
+		for data in tqdm(CUDAPrefetcher(self.train_dataloader, self.config['device'])):
+			if self.augment is not None:
+				# fronts are 0-255 floats, the range imgaug worked in on the uint8 images
+				with torch.no_grad():
+					data['fronts'] = [self.augment(front) for front in data['fronts']]
 
 			# efficiently zero gradients
 			# for p in self.model.parameters():
 			# 	p.grad = None
 
-			loss, _ = self.step(data)
+			with torch.cuda.amp.autocast(enabled=self.amp):
+				loss, _ = self.step(data)
 			self.optimizer.zero_grad()
 			try:
-				loss.backward()
+				self.scaler.scale(loss).backward()
 			except:
 				print(data)
-			loss_epoch += float(loss.item())
+			# accumulate on device, only sync at the end of the epoch
+			loss_epoch += loss.detach().float()
 
 			num_batches += 1
-			self.optimizer.step()
+			self.scaler.step(self.optimizer)
+			self.scaler.update()
 
-			self.writer.add_scalar('train_loss', loss.item(), self.cur_iter)
+			if self.cur_iter % self.log_interval == 0:
+				self.writer.add_scalar('train_loss', loss.item(), self.cur_iter)
 			self.cur_iter += 1
 		
 		
-		loss_epoch = loss_epoch / num_batches
+		loss_epoch = (loss_epoch / num_batches).item()
 		self.train_loss.append(loss_epoch)
 		self.cur_epoch += 1
 
@@ -68,15 +247,16 @@ class Trainer(object):
 
 		with torch.no_grad():	
 			num_batches = 0
-			wp_epoch = 0.
+			wp_epoch = torch.zeros((), device=self.config['device'])
 
 			# Validation loop
-			for batch_num, data in enumerate(tqdm(self.val_dataloader), 0):
+			for batch_num, data in enumerate(tqdm(CUDAPrefetcher(self.val_dataloader, self.config['device'])), 0):
 				
-				wp_epoch += float(self.step(data)[0])
+				with torch.cuda.amp.autocast(enabled=self.amp):
+					wp_epoch += self.step(data)[0].float()
 				num_batches += 1
 					
-			wp_loss = wp_epoch / float(num_batches)
+			wp_loss = (wp_epoch / num_batches).item()
 			tqdm.write(f'Epoch {self.cur_epoch:03d}, Batch {batch_num:03d}:' + f' Wp: {wp_loss:3.3f}')
 
 			self.writer.add_scalar('val_loss', wp_loss, self.cur_epoch)
@@ -138,30 +318,36 @@ class Trainer(object):
 		with torch.no_grad():	
 
 			# Validation loop
-			for data in tqdm(self.ss_dataloader):
+			for data in tqdm(CUDAPrefetcher(self.ss_dataloader, self.config['device'])):
 				
-				scenes, v1s, v2s, target_points, nav_commands, pred_wp, gt_waypoints = self.step(data)[1]
+				with torch.cuda.amp.autocast(enabled=self.amp):
+					scenes, v1s, v2s, target_points, nav_commands, pred_wp, gt_waypoints = self.step(data)[1]
+
+				# a single device to host copy per tensor instead of an .item() sync per value
+				v1s = v1s.cpu().numpy()
+				v2s = v2s.cpu().numpy()
+				target_points = target_points.cpu().numpy()
+				nav_commands = nav_commands.cpu().numpy()
+				pred_wp = pred_wp.float().cpu().numpy()
+				waypoints = np.concatenate([np.zeros((len(pred_wp), 1, 2), dtype=pred_wp.dtype), pred_wp[:, :, :2]], axis=1).tolist()
+
 				for i in range(len(scenes)):
 					
 					if self.config['predict_confidence']:
-						if pred_wp[i][len(pred_wp[0])-1][2].item() < self.config['confidence_threshold']:
+						if pred_wp[i, -1, 2] < self.config['confidence_threshold']:
 							continue
 
 					data_dict[scenes[i]] = dict(
 						v2 = v2s[i].item(),
 						v1 = v1s[i].item(),
 						scene=scenes[i],
-						target_point=tuple(target_points[i].cpu().numpy()),
-						waypoints=[],
-						nav_command=nav_commands[i].cpu().numpy(),
+						target_point=tuple(target_points[i]),
+						waypoints=[tuple(wp) for wp in waypoints[i]],
+						nav_command=nav_commands[i],
 					)
-
-					data_dict[scenes[i]]['waypoints'].append((0.0,0.0))
-					for j in range(len(pred_wp[0])):
-						data_dict[scenes[i]]['waypoints'].append((pred_wp[i][j][0].item(), pred_wp[i][j][1].item()))
 					
 					if self.config['predict_confidence']:
-						data_dict[scenes[i]]['confidence'] = pred_wp[i][len(pred_wp[0])-1][2].item()
+						data_dict[scenes[i]]['confidence'] = pred_wp[i, -1, 2].item()
 		
 		try:
 			existing_pseudo_data = list(np.load(pseudo_data_path, allow_pickle=True))
@@ -176,27 +362,23 @@ class Trainer(object):
 
 	def step(self, data):
 		
-		# create batch and move to GPU
-		fronts_in = data['fronts']
-		fronts = []
-		for i in range(self.config['seq_len']):
-			fronts.append(fronts_in[i].to(self.config['device'], dtype=torch.float32))
+		# batch is already on the GPU (see CUDAPrefetcher)
+		fronts = data['fronts'][:self.config['seq_len']]
 
 		# target point
-		# gt_velocity = data['velocity'].to(self.config['device'], dtype=torch.float32)
-		target_point = torch.stack(data['target_point'], dim=1).to(self.config['device'], dtype=torch.float32)
-		nav_command = data['nav_command'].to(self.config['device'], dtype=torch.float32)
+		# gt_velocity = data['velocity'].float()
+		target_point = data['target_point']
+		nav_command = data['nav_command']
 		
-		v1 = data['v1'].reshape((-1,1)).to(self.config['device'], dtype=torch.float32)
-		v2 = data['v1'].reshape((-1,1)).to(self.config['device'], dtype=torch.float32)
+		v1 = data['v1']
+		v2 = data['v1']
 		
 		# inference
 		encoding = [self.model.image_encoder(fronts)]
 		
 		pred_wp = self.model(feature_emb=encoding, v1=v1, v2=v2, target_point=target_point, nav_command=nav_command)
 		
-		gt_waypoints = [torch.stack(data['waypoints'][i], dim=1).to(self.config['device'], dtype=torch.float32) for i in range(self.config['seq_len'], len(data['waypoints']))]
-		gt_waypoints = torch.stack(gt_waypoints, dim=1).to(self.config['device'], dtype=torch.float32)
+		gt_waypoints = data['waypoints'][:, self.config['seq_len']:]
 
 		# if not torch.isfinite(target_point).all(): print('target_point', target_point)
 		# if not torch.isfinite(command).all(): print('command', command)
@@ -1,7 +1,5 @@
 from cmath import isnan
 import os
-from os import listdir
-from os.path import isfile, join, isdir
 import cv2
 import os
 from scipy.ndimage.measurements import label
@@ -14,15 +12,19 @@ from copy import deepcopy
 import multiprocessing as mp
 import sys
 import glob
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 
 def getAllFilesRecursive(root):
-    files = [ join(root,f) for f in listdir(root) if isfile(join(root,f))]
-    dirs = [ d for d in listdir(root) if isdir(join(root,d))]
+    # scandir entries cache their type, so there is no extra stat() per entry
+    files, dirs = [], []
+    for entry in os.scandir(root):
+        if entry.is_file():
+            files.append(entry.path)
+        elif entry.is_dir():
+            dirs.append(entry.path)
     for d in dirs:
-        files_in_d = getAllFilesRecursive(join(root,d))
-        if files_in_d:
-            for f in files_in_d:
-                files.append(join(root,f))
+        files.extend(getAllFilesRecursive(d))
     return files
 
 def get_scenes(town_path):
@@ -35,11 +37,33 @@ def get_scenes(town_path):
 
     return scenes
 
-def get_measurements(scene):
+def read_json(path):
     try:
-        with open(scene.replace('png','json').replace('rgb_front','measurements'), 'r') as f:
-            data = json.load(f)
+        with open(path, 'rb') as f:
+            raw = f.read()
     except:
+        return None
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # orjson rejects the NaN literals json.dump writes for an undefined theta
+        try:
+            return json.loads(raw)
+        except:
+            return None
+
+def read_measurements(route_path, max_workers=16):
+    """
+    Read all measurement files of a route concurrently, keyed by path.
+    """
+    files = glob.glob(f'{route_path}/measurements/*.json')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(files, executor.map(read_json, files)))
+
+def get_measurements(scene, measurements=None):
+    path = scene.replace('png','json').replace('rgb_front','measurements')
+    data = measurements.get(path) if measurements is not None and path in measurements else read_json(path)
+    if data is None:
         data = dict(
             x=0,
             y=0,
@@ -51,31 +75,6 @@ def get_measurements(scene):
     return data
 
 
-def transform_2d_points(xyz, r1, t1_x, t1_y, r2, t2_x, t2_y):
-    """
-    Build a rotation matrix and take the dot product.
-    """
-    # z value to 1 for rotation
-    xy1 = xyz.copy()
-    xy1[:,2] = 1
-
-    c, s = np.cos(r1), np.sin(r1)
-    r1_to_world = np.matrix([[c, s, t1_x], [-s, c, t1_y], [0, 0, 1]])
-
-    # np.dot converts to a matrix, so we explicitly change it back to an array
-    world = np.asarray(r1_to_world @ xy1.T)
-
-    c, s = np.cos(r2), np.sin(r2)
-    r2_to_world = np.matrix([[c, s, t2_x], [-s, c, t2_y], [0, 0, 1]])
-    world_to_r2 = np.linalg.inv(r2_to_world)
-
-    out = np.asarray(world_to_r2 @ world).T
-    
-    # reset z-coordinate
-    out[:,2] = xyz[:,2]
-
-    return out
-
 def calc_wp(seq_x, seq_y, seq_theta, seq_len, pred_len):
 
     i = seq_len-1
@@ -83,15 +82,16 @@ def calc_wp(seq_x, seq_y, seq_theta, seq_len, pred_len):
     ego_y = seq_y[i]
     ego_theta = seq_theta[i]
     
-    waypoints = []
-    for i in range(seq_len + pred_len):
-        # waypoint is the transformed version of the origin in local coordinates
-        # we use 90-theta instead of theta
-        # LBC code uses 90+theta, but x is to the right and y is downwards here
-        local_waypoint = transform_2d_points(np.zeros((1,3)), 
-            np.pi/2-seq_theta[i], -seq_x[i], -seq_y[i], np.pi/2-ego_theta, -ego_x, -ego_y)
-        waypoints.append(tuple(local_waypoint[0,:2]))
-    return waypoints
+    # waypoint is the transformed version of the origin in local coordinates
+    # we use 90-theta instead of theta
+    # LBC code uses 90+theta, but x is to the right and y is downwards here
+    # the origin of every frame sits at (-x, -y) in world coordinates, so all waypoints
+    # only need the inverse ego transform: the transposed rotation of the offset to the ego
+    c, s = np.cos(np.pi/2-ego_theta), np.sin(np.pi/2-ego_theta)
+    dx = ego_x - np.asarray(seq_x[:seq_len+pred_len])
+    dy = ego_y - np.asarray(seq_y[:seq_len+pred_len])
+    waypoints = np.stack([c*dx - s*dy, s*dx + c*dy], axis=1)
+    return [tuple(wp) for wp in waypoints]
 
 def filter_data(path_to_npy, data):
     processed_data = np.load(path_to_npy, allow_pickle=True)
@@ -174,11 +174,12 @@ def worker(town, routes, data_path, seq_len, pred_len, dest_path):
     data = dict()
     for route in tqdm.tqdm(routes, desc='route', leave=False):
         scenes = get_scenes(f'{data_path}/{town}/{route}')
+        route_measurements = read_measurements(f'{data_path}/{town}/{route}')
         
         for scene in tqdm.tqdm(scenes, desc='scene', leave=False):
             try:
                 index = int(scene[-8:-4])
-                measurements = get_measurements(scene)
+                measurements = get_measurements(scene, route_measurements)
                 
                 ego_x = measurements['x']
                 ego_y = measurements['y']
@@ -200,7 +201,7 @@ def worker(town, routes, data_path, seq_len, pred_len, dest_path):
                 c_img = str(index).zfill(4)
                 for i in range(index, index+seq_len+pred_len):    
                     f_img = str(i).zfill(4)
-                    measurements = get_measurements(scene.replace(c_img, f_img))
+                    measurements = get_measurements(scene.replace(c_img, f_img), route_measurements)
                     seq_x.append(measurements['x'])
                     seq_y.append(measurements['y'])
                     seq_theta.append(np.pi if np.isnan(measurements['theta']) else measurements['theta'])